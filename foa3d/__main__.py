@@ -1,7 +1,12 @@
+import signal
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
 from foa3d.input import get_cli_parser, load_microscopy_image
 from foa3d.pipeline import parallel_frangi_over_slices, parallel_odf_over_scales
 from foa3d.printing import print_pipeline_heading
-from foa3d.utils import delete_tmp_data
+from foa3d.utils import delete_tmp_data, get_available_ram
 
 
 def foa3d(cli_args):
@@ -9,17 +14,32 @@ def foa3d(cli_args):
     # load 3D grayscale or RGB microscopy image or 4D array of fiber orientation vectors
     in_img, save_dirs = load_microscopy_image(cli_args)
 
-    # parallel 3D Frangi-based fiber orientation analysis on batches of basic image slices
-    out_img = parallel_frangi_over_slices(cli_args, save_dirs, in_img)
+    # split the RAM budget between the background saving of the Frangi filter arrays
+    # and the concurrent ODF stage (net of the temporary arrays held in shared memory)
+    ram = get_available_ram(None if cli_args.ram is None else cli_args.ram * 1024**3, rsv=save_dirs['tmp_rsv'])
+    with ThreadPoolExecutor(max_workers=1) as sv_pool:
+
+        # parallel 3D Frangi-based fiber orientation analysis on batches of basic image slices
+        # (output arrays are saved in the background)
+        out_img, sv_job = parallel_frangi_over_slices(cli_args, save_dirs, in_img, sv_pool=sv_pool, sv_ram=ram // 2)
 
-    # generate 3D fiber ODF maps at the spatial scales of interest using concurrent workers
-    parallel_odf_over_scales(cli_args, save_dirs, out_img, in_img['name'])
+        # generate 3D fiber ODF maps at the spatial scales of interest using concurrent workers
+        parallel_odf_over_scales(cli_args, save_dirs, out_img, in_img['name'],
+                                 ram=ram if sv_job is None else ram // 2)
+
+        # wait for the Frangi filter arrays to be saved
+        if sv_job is not None:
+            sv_job.result()
 
     # delete temporary folder
     delete_tmp_data(save_dirs['tmp'], (in_img, out_img))
 
 
 def main():
+
+    # exit cleanly on termination requests, so that the temporary data are removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
     print_pipeline_heading()
     foa3d(cli_args=get_cli_parser())
 
@@ -1,22 +1,41 @@
 import argparse
 
+from functools import lru_cache
+from importlib.util import find_spec
+from math import ceil, floor
+from multiprocessing import cpu_count
 from time import perf_counter
-from os import path
+from os import path, scandir
 
 import numpy as np
-import tifffile as tiff
-
-try:
-    from zetastitcher import VirtualFusedVolume
-except ImportError:
-    pass
 
 from foa3d.output import create_save_dirs
 from foa3d.preprocessing import config_anisotropy_correction
 from foa3d.printing import (color_text, print_flsh, print_image_info,
                             print_import_time)
-from foa3d.utils import (create_background_mask, create_memory_map,
-                         detect_ch_axis, get_item_bytes, get_config_label)
+from foa3d.utils import (compute_tissue_mip, create_background_mask, create_memory_map,
+                         detect_ch_axis, get_available_ram, get_item_bytes,
+                         get_config_label)
+
+
+CLI_DESCRIPTION = ('Foa3D: A 3D Fiber Orientation Analysis Pipeline\n'
+                   'author:     Michele Sorelli (2022)\n'
+                   'references: Frangi  et al.  (1998) '
+                   'Multiscale vessel enhancement filtering.'
+                   ' In Medical Image Computing and'
+                   ' Computer-Assisted Intervention 1998, pp. 130-137.\n'
+                   '            Alimi   et al.  (2020) '
+                   'Analytical and fast Fiber Orientation Distribution '
+                   'reconstruction in 3D-Polarized Light Imaging. '
+                   'Medical Image Analysis, 65, pp. 101760.\n'
+                   '            Sorelli et al.  (2023) '
+                   'Fiber enhancement and 3D orientation analysis '
+                   'in label-free two-photon fluorescence microscopy. '
+                   'Scientific Reports, 13, pp. 4160.\n')
+
+
+THR_METHODS = ('li', 'niblack', 'sauvola', 'triangle', 'yen')
+TIFF_CMP = ('none', 'zlib', 'zstd')
 
 
 class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawTextHelpFormatter):
@@ -32,27 +51,29 @@ def get_cli_parser():
     cli_args: see ArgumentParser.parse_args
         populated namespace of command line arguments
     """
+    cli_args = build_cli_parser().parse_args()
+
+    return cli_args
+
+
+@lru_cache(maxsize=1)
+def build_cli_parser():
+    """
+    Build the command line argument parser (constructed once and cached).
+
+    Returns
+    -------
+    cli_parser: argparse.ArgumentParser
+        command line argument parser
+    """
     # configure parser object
-    cli_parser = argparse.ArgumentParser(
-        description='Foa3D: A 3D Fiber Orientation Analysis Pipeline\n'
-                    'author:     Michele Sorelli (2022)\n'
-                    'references: Frangi  et al.  (1998) '
-                    'Multiscale vessel enhancement filtering.'
-                    ' In Medical Image Computing and'
-                    ' Computer-Assisted Intervention 1998, pp. 130-137.\n'
-                    '            Alimi   et al.  (2020) '
-                    'Analytical and fast Fiber Orientation Distribution '
-                    'reconstruction in 3D-Polarized Light Imaging. '
-                    'Medical Image Analysis, 65, pp. 101760.\n'
-                    '            Sorelli et al.  (2023) '
-                    'Fiber enhancement and 3D orientation analysis '
-                    'in label-free two-photon fluorescence microscopy. '
-                    'Scientific Reports, 13, pp. 4160.\n',
-        formatter_class=CustomFormatter)
+    cli_parser = argparse.ArgumentParser(description=CLI_DESCRIPTION, formatter_class=CustomFormatter)
     cli_parser.add_argument(dest='image_path',
                             help='path to input 3D microscopy image or 4D array of fiber orientation vectors\n'
                                  '* supported formats:\n'
                                  '  - .tif .tiff (microscopy image or fiber orientation vectors)\n'
+                                 '  - folder of 2D .tif .tiff images (microscopy z-stack)\n'
+                                 '  - .npy (fiber orientation vectors)\n'
                                  '  - .yml (ZetaStitcher\'s stitch file of tiled microscopy reconstruction)\n'
                                  '* image axes order:\n'
                                  '  - grayscale image:      (Z, Y, X)\n'
@@ -68,7 +89,7 @@ def get_cli_parser():
     cli_parser.add_argument('-s', '--scales', nargs='+', type=float, default=[1.25],
                             help='list of Frangi filter scales [μm]')
     cli_parser.add_argument('-j', '--jobs', type=int, default=None,
-                            help='number of parallel threads used by the Frangi filter stage: '
+                            help='number of parallel threads used by the image import and Frangi filter stages: '
                                  'use one thread per logical core if None')
     cli_parser.add_argument('-r', '--ram', type=float, default=None,
                             help='maximum RAM available to the Frangi filter stage [GB]: use all if None')
@@ -79,7 +100,7 @@ def get_cli_parser():
     cli_parser.add_argument('--psf-fwhm-z', type=float, default=1.0, help='PSF FWHM along depth z-axis [μm]')
     cli_parser.add_argument('--fb-ch', type=int, default=1, help='neuronal fibers channel')
     cli_parser.add_argument('--bc-ch', type=int, default=0, help='brain cell soma channel')
-    cli_parser.add_argument('--fb-thr', default='li', type=str,
+    cli_parser.add_argument('--fb-thr', default='li', type=parse_fb_thr,
                             help='Frangi filter probability response threshold (t ∈ [0, 1] or skimage.filters method)')
     cli_parser.add_argument('--z-min', type=float, default=0, help='forced minimum output z-depth [μm]')
     cli_parser.add_argument('--z-max', type=float, default=None, help='forced maximum output z-depth [μm]')
@@ -91,6 +112,9 @@ def get_cli_parser():
                             help='degrees of the spherical harmonics series expansion (even number between 2 and 10)')
     cli_parser.add_argument('-o', '--out', type=str, default=None,
                             help='output directory')
+    cli_parser.add_argument('--tiff-cmp', type=parse_tiff_cmp, default='none',
+                            help='compression of the output TIFF files (none, zlib or zstd): '
+                                 'zstd requires the imagecodecs package')
     cli_parser.add_argument('-c', '--cell-msk', action='store_true', default=False,
                             help='apply neuronal body mask (the optional channel of neuronal bodies must be available)')
     cli_parser.add_argument('-t', '--tissue-msk', action='store_true', default=False,
@@ -99,9 +123,7 @@ def get_cli_parser():
                             help='save the full range of images produced by the Frangi filter and ODF stages, '
                                  'e.g. for testing purposes (see documentation)')
 
-    cli_args = cli_parser.parse_args()
-
-    return cli_args
+    return cli_parser
 
 
 def get_image_size(in_img):
@@ -158,15 +180,19 @@ def get_image_size(in_img):
     None
     """
     # adapt channel axis
-    img_shp = np.asarray(in_img['data'].shape)
-    if in_img['ch_ax'] is None:
+    img_shp = in_img['data'].shape
+    ch_ax = in_img['ch_ax']
+    if ch_ax is None:
         in_img.update({'fb_ch': None, 'msk_bc': False})
     else:
-        img_shp = np.delete(img_shp, in_img['ch_ax'])
+        img_shp = img_shp[:ch_ax] + img_shp[ch_ax + 1:]
 
+    img_shp = np.array(img_shp, dtype=np.int64)
+    item_sz = get_item_bytes(in_img['data'])
     in_img.update({'shape': img_shp,
-                   'shape_um': np.multiply(img_shp, in_img['px_sz']),
-                   'item_sz': get_item_bytes(in_img['data'])})
+                   'shape_um': img_shp * in_img['px_sz'],
+                   'item_sz': item_sz,
+                   'nbytes': item_sz * int(np.prod(img_shp))})
 
 
 def get_image_info(cli_args):
@@ -214,16 +240,21 @@ def get_image_info(cli_args):
         apply tissue reconstruction mask (binarized MIP)
     """
     # get microscopy image path and name
-    img_path = cli_args.image_path
-    img_name = path.basename(img_path)
-    split_name = img_name.split('.')
+    img_path = path.normpath(cli_args.image_path)
+
+    # folder of 2D TIFF images (z-stack sequence)
+    if path.isdir(img_path):
+        img_name, img_fmt = path.basename(img_path), 'tif'
 
     # check image format
-    if len(split_name) == 1:
-        raise ValueError('Format must be specified for input volume images!')
-    img_fmt = split_name[-1]
-    img_name = img_name.replace(f'.{img_fmt}', '')
-    is_tiled = True if img_fmt == 'yml' else False
+    else:
+        img_name, img_fmt = path.splitext(path.basename(img_path))
+        if not img_fmt:
+            raise ValueError('Format must be specified for input volume images!')
+        img_fmt = img_fmt[1:].lower()
+        if img_fmt not in ('tif', 'tiff', 'npy', 'yml'):
+            raise ValueError('Unsupported image format!')
+    is_tiled = img_fmt == 'yml'
 
     # apply tissue reconstruction mask (binarized MIP) and/or brain cell soma mask
     msk_mip = cli_args.tissue_msk
@@ -347,22 +378,24 @@ def get_frangi_config(cli_args, in_img):
     """
     # preprocessing configuration (adaptive smoothing)
     smooth_sd, out_px_sz = config_anisotropy_correction(in_img['px_sz'], in_img['psf_fwhm'])
-    scales_px = np.array(cli_args.scales) / np.max(out_px_sz)
 
-    # adapted output z-axis range when required
-    z_min = max(0, int(np.floor(cli_args.z_min / np.max(in_img['px_sz']))))
-    z_max = min(int(np.ceil(cli_args.z_max / np.max(in_img['px_sz']))), in_img['shape'][0]) \
-        if cli_args.z_max is not None else in_img['shape'][0]
+    # sorted unique Frangi filter scales (avoid redundant filtering at duplicate scales)
+    scales_um = np.unique(np.asarray(cli_args.scales, dtype=np.float32))
+    if scales_um.size == 0 or np.any(scales_um <= 0):
+        raise ValueError('Frangi filter scales must be positive!')
+    scales_px = np.ascontiguousarray(scales_um / np.max(out_px_sz))
 
-    # get threshold applied to the Frangi filter response
-    fb_thr = cli_args.fb_thr
-    if fb_thr.replace('.', '', 1).isdigit():
-        fb_thr = float(fb_thr)
+    # adapted output z-axis range when required
+    # (using the original double-precision pixel size from the command line)
+    px_sz_max = max(cli_args.px_size_z, cli_args.px_size_xy)
+    z_tot = int(in_img['shape'][0])
+    z_min = max(0, floor(cli_args.z_min / px_sz_max))
+    z_max = min(ceil(cli_args.z_max / px_sz_max), z_tot) if cli_args.z_max is not None else z_tot
 
     # compile Frangi filter configuration dictionary
     frangi_cfg = {'alpha': cli_args.alpha, 'beta': cli_args.beta, 'gamma': cli_args.gamma,
-                  'scales_um': np.array(cli_args.scales), 'scales_px': scales_px, 'smooth_sd': smooth_sd,
-                  'px_sz': out_px_sz, 'fb_thr': fb_thr, 'hsv_cmap': cli_args.hsv,
+                  'scales_um': scales_um, 'scales_px': scales_px, 'smooth_sd': smooth_sd,
+                  'px_sz': out_px_sz, 'fb_thr': cli_args.fb_thr, 'hsv_cmap': cli_args.hsv,
                   'exp_all': cli_args.exp_all, 'z_out': slice(z_min, z_max, 1)}
 
     return frangi_cfg
@@ -379,19 +412,87 @@ def get_resolution(cli_args):
 
     Returns
     -------
-    px_sz: tuple (shape=(3,), dtype=float)
+    px_sz: numpy.ndarray (shape=(3,), dtype=float32)
         pixel size [μm]
 
-    psf_fwhm: tuple (shape=(3,), dtype=float)
+    psf_fwhm: numpy.ndarray (shape=(3,), dtype=float32)
         3D PSF FWHM [μm]
     """
-    px_sz = (cli_args.px_size_z, cli_args.px_size_xy, cli_args.px_size_xy)
-    psf_fwhm = (cli_args.psf_fwhm_z, cli_args.psf_fwhm_y, cli_args.psf_fwhm_x)
+    px_sz = np.array([cli_args.px_size_z, cli_args.px_size_xy, cli_args.px_size_xy], dtype=np.float32)
+    psf_fwhm = np.array([cli_args.psf_fwhm_z, cli_args.psf_fwhm_y, cli_args.psf_fwhm_x], dtype=np.float32)
 
     return px_sz, psf_fwhm
 
 
-def get_resource_config(cli_args, frangi_cfg):
+def parse_fb_thr(fb_thr):
+    """
+    Resolve the Frangi filter probability response threshold
+    passed via the command line.
+
+    Parameters
+    ----------
+    fb_thr: str
+        global threshold value (t ∈ [0, 1])
+        or skimage.filters thresholding method
+
+    Returns
+    -------
+    fb_thr: float or str
+        Frangi filter probability response threshold
+
+    Raises
+    ------
+    argparse.ArgumentTypeError
+        if an unsupported thresholding method
+        or a threshold value outside [0, 1] is provided
+    """
+    fb_thr = fb_thr.lower()
+    if fb_thr in THR_METHODS:
+        return fb_thr
+
+    try:
+        thr = float(fb_thr)
+    except ValueError as ve:
+        raise argparse.ArgumentTypeError(f"unsupported thresholding method: '{fb_thr}' "
+                                         f"(choose from {', '.join(THR_METHODS)})") from ve
+    if not 0 <= thr <= 1:
+        raise argparse.ArgumentTypeError(f"threshold value must be within [0, 1]: {thr}")
+
+    return thr
+
+
+def parse_tiff_cmp(tiff_cmp):
+    """
+    Resolve the compression of the output TIFF files
+    passed via the command line.
+
+    Parameters
+    ----------
+    tiff_cmp: str
+        TIFF compression ('none', 'zlib' or 'zstd')
+
+    Returns
+    -------
+    tiff_cmp: str
+        TIFF compression
+
+    Raises
+    ------
+    argparse.ArgumentTypeError
+        if an unsupported compression is provided,
+        or if zstd is selected and imagecodecs is not installed
+    """
+    tiff_cmp = tiff_cmp.lower()
+    if tiff_cmp not in TIFF_CMP:
+        raise argparse.ArgumentTypeError(f"unsupported TIFF compression: '{tiff_cmp}' "
+                                         f"(choose from {', '.join(TIFF_CMP)})")
+    if tiff_cmp == 'zstd' and find_spec('imagecodecs') is None:
+        raise argparse.ArgumentTypeError("zstd TIFF compression requires the imagecodecs package")
+
+    return tiff_cmp
+
+
+def get_resource_config(cli_args, frangi_cfg, rsv=0):
     """
     Retrieve resource usage configuration of the Foa3D tool.
 
@@ -443,6 +544,10 @@ def get_resource_config(cli_args, frangi_cfg):
             rsz: numpy.ndarray (shape=(3,), dtype=float)
                 3D image resize ratio
 
+    rsv: int
+        RAM reserved by the temporary data
+        on the shared memory file system [B]
+
     Returns
     -------
     None
@@ -452,7 +557,7 @@ def get_resource_config(cli_args, frangi_cfg):
     if ram is not None:
         ram *= 1024**3
 
-    frangi_cfg.update({'jobs': jobs, 'ram': ram})
+    frangi_cfg.update({'jobs': jobs, 'ram': get_available_ram(ram, rsv=rsv)})
 
 
 def load_microscopy_image(cli_args):
@@ -521,6 +626,9 @@ def load_microscopy_image(cli_args):
             item_sz: int
                 image item size [B]
 
+            nbytes: int
+                total image size [B]
+
     save_dirs: dict
         saving directories
         ('frangi': Frangi filter, 'odf': ODF analysis, 'tmp': temporary files)
@@ -531,7 +639,8 @@ def load_microscopy_image(cli_args):
 
     # import fiber orientation vector data or raw 3D microscopy image
     tic = perf_counter()
-    load_data(in_img, save_dirs['tmp'], msk_mip=msk_mip)
+    ram = None if cli_args.ram is None else cli_args.ram * 1024**3
+    load_data(in_img, save_dirs['tmp'], msk_mip=msk_mip, jobs=cli_args.jobs, ram=ram)
 
     # print input data information
     get_image_size(in_img)
@@ -544,7 +653,7 @@ def load_microscopy_image(cli_args):
     return in_img, save_dirs
 
 
-def load_data(in_img, tmp_dir, msk_mip=False):
+def load_data(in_img, tmp_dir, msk_mip=False, jobs=None, ram=None):
     """
     Load 3D microscopy data.
 
@@ -586,6 +695,14 @@ def load_data(in_img, tmp_dir, msk_mip=False):
     msk_mip: bool
         apply tissue reconstruction mask (binarized MIP)
 
+    jobs: int
+        number of parallel threads used to decode compressed TIFF pages:
+        use one thread per logical core if None
+
+    ram: float
+        maximum RAM available to the MIP computation of tiled reconstructions [B]
+        (use all if None)
+
     Returns
     -------
     None
@@ -595,6 +712,7 @@ def load_data(in_img, tmp_dir, msk_mip=False):
     # load tiled reconstruction (aligned using ZetaStitcher)
     if in_img['is_tiled']:
         print_flsh(f"Loading {in_img['path']} tiled reconstruction...\n")
+        from zetastitcher import VirtualFusedVolume
         img = VirtualFusedVolume(in_img['path'])
         ch_ax = detect_ch_axis(img)
         is_vec = False
@@ -603,38 +721,72 @@ def load_data(in_img, tmp_dir, msk_mip=False):
     else:
         print_flsh(f"Loading {in_img['path']} z-stack...\n")
 
-        img_fmt = in_img['fmt'].lower()
-        if img_fmt in ('tif', 'tiff'):
-            img = tiff.imread(in_img['path'])
-            ch_ax = detect_ch_axis(img)
+        if in_img['fmt'] in ('tif', 'tiff'):
+            import tifffile as tiff
+
+            # read a folder of 2D TIFF images (natural sort order)
+            # straight into a preallocated memory-map
+            if path.isdir(in_img['path']):
+                pln_paths = tiff.natural_sorted([f.path for f in scandir(in_img['path'])
+                                                 if f.is_file() and f.name.lower().endswith(('.tif', '.tiff'))])
+                seq = tiff.TiffSequence(pln_paths)
+                if seq.shape != (len(pln_paths),) or list(seq) != pln_paths:
+                    seq.close()
+                    raise ValueError(f"Unable to preserve the z-order of the 2D TIFF images in {in_img['path']}")
+                with tiff.TiffFile(seq[0]) as tif:
+                    page_shp, page_dtype = tif.series[0].shape, tif.series[0].dtype
+                img = create_memory_map(seq.shape + page_shp, dtype=page_dtype, name=in_img['name'], tmp=tmp_dir)
+                seq.asarray(out=img, ioworkers=cpu_count() if jobs is None else jobs)
+                seq.close()
+
+            # memory-map contiguous TIFF data directly,
+            # or decode compressed TIFF data straight into a preallocated memory-map
+            else:
+                with tiff.TiffFile(in_img['path']) as tif:
+                    series = tif.series[0]
+                    if series.dataoffset is not None:
+                        img = np.memmap(in_img['path'], dtype=np.dtype(tif.byteorder + series.dtype.char),
+                                        mode='r', offset=series.dataoffset, shape=series.shape)
+                    else:
+                        img = create_memory_map(series.shape, dtype=series.dtype, name=in_img['name'], tmp=tmp_dir)
+                        series.asarray(out=img, maxworkers=cpu_count() if jobs is None else jobs)
+
+        # memory-map NumPy arrays (e.g. fiber orientation vectors)
+        elif in_img['fmt'] == 'npy':
+            img = np.load(in_img['path'], mmap_mode='r')
 
-            # detect vector field input
-            is_vec = img.ndim == 4 and img.dtype in (np.float32, float, 'float32')
-            if is_vec:
-                if ch_ax != 3:
-                    img = np.moveaxis(img, ch_ax, -1)
-
-            img = create_memory_map(img.shape, dtype=img.dtype, name=in_img['name'],
-                                    tmp=tmp_dir, arr=img, mmap_mode='r')
         else:
             raise ValueError('Unsupported image format!')
 
+        ch_ax = detect_ch_axis(img)
+
+        # detect vector field input
+        is_vec = img.ndim == 4 and img.dtype in (np.float32, float, 'float32')
+        if is_vec and ch_ax != 3:
+            img = np.moveaxis(img, ch_ax, -1)
+
+        # copy to a new memory-map only non-contiguous views of the mapped data
+        # (transposing ~64 MiB z-slabs to keep both reads and writes sequential)
+        if not img.flags.c_contiguous:
+            img_c = create_memory_map(img.shape, dtype=img.dtype, name=f"{in_img['name']}_c", tmp=tmp_dir)
+            dz = max(1, 2**26 // (img.itemsize * int(np.prod(img.shape[1:]))))
+            for z in range(0, img.shape[0], dz):
+                np.copyto(img_c[z:z + dz], img[z:z + dz])
+            img = img_c
+
     # generate tissue background mask
     if not is_vec and msk_mip:
-        dims = len(img.shape)
-        if dims == 3:
-            img_fbr = img
-        elif dims == 4:
-            img_fbr = img[:, in_img['fb_ch'], :, :] if ch_ax == 1 else img[..., in_img['fb_ch']]
-        else:
+        if len(img.shape) not in (3, 4):
             raise ValueError('Invalid image (ndim != 3 and ndim != 4)!')
 
-        # compute MIP (naive for loop to minimize the required RAM)
-        ts_mip = np.zeros(img_fbr.shape[1:], dtype=img_fbr.dtype)
-        for z in range(img_fbr.shape[0]):
-            stk = np.stack((ts_mip, img_fbr[z]))
-            ts_mip = np.max(stk, axis=0)
-
+        # compute MIP (reducing z-chunks to minimize the required RAM):
+        # tiled reconstructions are streamed in whole tile slabs
+        # (two slabs in memory at a time, within the RAM budget)
+        dz = None
+        if in_img['is_tiled']:
+            pln_sz = get_item_bytes(img) * int(np.prod(img.shape[1:]))
+            dz = max(1, min(img.temp_shape[0], int(get_available_ram(ram) // (2 * pln_sz))))
+        ts_mip = compute_tissue_mip(img, ch_ax=ch_ax, ch=in_img['fb_ch'], dz=dz)
         ts_msk = create_background_mask(ts_mip, method='li', black_bg=True)
     else:
         ts_msk = None
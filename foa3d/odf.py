@@ -1,13 +1,11 @@
 import numpy as np
-import scipy as sp
-from numba import njit
-from skimage.transform import resize
+from numba import njit, prange
 
-from foa3d.spharm import fiber_vectors_to_sph_harm, get_sph_harm_ncoeff
-from foa3d.utils import create_memory_map, normalize_image, transform_axes
+from foa3d.spharm import fiber_vectors_to_sph_harm, get_sph_harm_ncoeff, sph_harm_max_deg
+from foa3d.utils import compute_block_mean, create_memory_map, normalize_image, transform_axes
 
 
-def compute_odf_map(fbr_vec, px_sz, odf, odi, fbr_dnst, vec_tnsr_eig, scale, norm, deg=6, vx_thr=0.5, vec_thr=1e-6):
+def compute_odf_map(fbr_vec, px_sz, odf, odi, fbr_dnst, vec_tnsr_eig, scale, deg=6, vx_thr=0.5, vec_thr=1e-6):
     """
     Compute the spherical harmonics coefficients iterating over super-voxels
     of fiber orientation vectors.
@@ -47,9 +45,6 @@ def compute_odf_map(fbr_vec, px_sz, odf, odi, fbr_dnst, vec_tnsr_eig, scale, nor
     scale: int
         side of the ODF super-voxel [px]
 
-    norm: numpy.ndarray (dtype: float)
-        2D array of spherical harmonics normalization factors
-
     deg: int
         degrees of the spherical harmonics series expansion
 
@@ -67,31 +62,13 @@ def compute_odf_map(fbr_vec, px_sz, odf, odi, fbr_dnst, vec_tnsr_eig, scale, nor
     fbr_dnst: numpy.ndarray (axis order=(Z,Y,X), dtype=float)
         fiber density image
     """
-    # iterate over super-voxels
+    if deg > sph_harm_max_deg:
+        raise ValueError("\n  Invalid degree of the spherical harmonics series expansion!!!")
+
+    # compute the ODF coefficients, fiber density and orientation tensor eigenvalues of all super-voxels
     px_vol = np.prod(px_sz)
     ref_vx_vol = min(scale, fbr_vec.shape[0]) * scale**2
-    for z in range(0, fbr_vec.shape[0], scale):
-        z_max = z + scale
-        for y in range(0, fbr_vec.shape[1], scale):
-            y_max = y + scale
-            for x in range(0, fbr_vec.shape[2], scale):
-                x_max = x + scale
-
-                # select super-voxel of fiber orientation data
-                vec_vx = fbr_vec[z:z_max, y:y_max, x:x_max, :]
-                zerovec = np.count_nonzero(np.all(vec_vx == 0, axis=-1))
-                vx_vol = np.prod(vec_vx.shape[:-1])
-
-                # compute local fiber density
-                zv, yv, xv = z // scale, y // scale, x // scale
-                fbr_dnst[zv, yv, xv] = (vx_vol - zerovec) / (vx_vol * px_vol)
-
-                # compute ODF and orientation tensor eigenvalues
-                # (skipping boundary voxels and voxels without enough data)
-                if vx_vol / ref_vx_vol > vx_thr and 1 - zerovec / vx_vol > vec_thr:
-                    vec_arr = vec_vx.ravel()
-                    odf[zv, yv, xv, :] = fiber_vectors_to_sph_harm(vec_arr, deg, norm)
-                    vec_tnsr_eig[zv, yv, xv, :] = compute_vec_tensor_eigen(vec_arr)
+    compute_super_voxel_odf(fbr_vec, odf, fbr_dnst, vec_tnsr_eig, scale, px_vol, ref_vx_vol, vx_thr, vec_thr)
 
     # compute dispersion and anisotropy parameters
     compute_orientation_dispersion(vec_tnsr_eig, **odi)
@@ -151,6 +128,86 @@ def compute_orientation_dispersion(vec_tnsr_eig, odi_pri, odi_sec, odi_tot, odi_
                   np.arctan2(avte[..., 2], np.sqrt(np.abs(np.multiply(avte[..., 1], avte[..., 0]))))).astype(np.float32)
 
 
+@njit(cache=True, fastmath=True, nogil=True, parallel=True)
+def compute_super_voxel_odf(fbr_vec, odf, fbr_dnst, vec_tnsr_eig, scale, px_vol, ref_vx_vol, vx_thr, vec_thr):
+    """
+    Compute the spherical harmonics coefficients, the fiber density
+    and the orientation tensor eigenvalues of all the ODF super-voxels
+    in a single compiled pass over the fiber orientation vectors (parallel over super-voxels).
+
+    Parameters
+    ----------
+    fbr_vec: NumPy memory-map object (axis order=(Z,Y,X,C), dtype=float)
+        fiber orientation vectors
+
+    odf: NumPy memory-map object (axis order=(Z,Y,X,C), dtype=float32)
+        initialized array of ODF spherical harmonics coefficients
+
+    fbr_dnst: NumPy memory-map object (axis order=(Z,Y,X), dtype=float)
+        initialized fiber density image
+
+    vec_tnsr_eig: NumPy memory-map object (axis order=(Z,Y,X,C), dtype=float32)
+        initialized array of orientation tensor eigenvalues
+
+    scale: int
+        side of the ODF super-voxel [px]
+
+    px_vol: float
+        pixel volume [μm³]
+
+    ref_vx_vol: int
+        reference super-voxel volume [px]
+
+    vx_thr: float
+        minimum relative threshold on the sliced voxel volume
+
+    vec_thr: float
+        minimum relative threshold on non-zero orientation vectors
+
+    Returns
+    -------
+    None
+    """
+    # super-voxels are independent: distribute them over parallel threads
+    ncoeff = odf.shape[-1]
+    ny, nx = odf.shape[1:3]
+    for b in prange(odf.shape[0] * ny * nx):
+        zv, yv, xv = b // (ny * nx), (b // nx) % ny, b % nx
+        z, y, x = zv * scale, yv * scale, xv * scale
+        z_max = min(z + scale, fbr_vec.shape[0])
+        y_max = min(y + scale, fbr_vec.shape[1])
+        x_max = min(x + scale, fbr_vec.shape[2])
+
+        # gather the non-zero fiber orientation vectors of the super-voxel (and their 2-norm)
+        vx_vol = (z_max - z) * (y_max - y) * (x_max - x)
+        vec_vx = np.empty((vx_vol, 3), dtype=fbr_vec.dtype)
+        vec_norm = np.empty(vx_vol, dtype=fbr_vec.dtype)
+        nvec = 0
+        for zz in range(z, z_max):
+            for yy in range(y, y_max):
+                for xx in range(x, x_max):
+                    v0 = fbr_vec[zz, yy, xx, 0]
+                    v1 = fbr_vec[zz, yy, xx, 1]
+                    v2 = fbr_vec[zz, yy, xx, 2]
+                    if v0 != 0 or v1 != 0 or v2 != 0:
+                        vec_vx[nvec, 0] = v0
+                        vec_vx[nvec, 1] = v1
+                        vec_vx[nvec, 2] = v2
+                        vec_norm[nvec] = np.sqrt(v0 * v0 + v1 * v1 + v2 * v2)
+                        nvec += 1
+
+        # compute local fiber density
+        fbr_dnst[zv, yv, xv] = nvec / (vx_vol * px_vol)
+
+        # compute ODF and orientation tensor eigenvalues
+        # (skipping boundary voxels and voxels without enough data)
+        if vx_vol / ref_vx_vol > vx_thr and nvec / vx_vol > vec_thr:
+            if np.sum(vec_norm[:nvec]) >= np.sqrt(vx_vol):
+                odf[zv, yv, xv, :] = fiber_vectors_to_sph_harm(vec_vx[:nvec], vec_norm[:nvec], ncoeff)
+            vec_tnsr_eig[zv, yv, xv, :] = compute_vec_tensor_eigen(vec_vx[:nvec])
+
+
+@njit(cache=True)
 def compute_vec_tensor_eigen(fbr_vec):
     """
     Compute the eigenvalues of the 3x3 orientation tensor
@@ -159,21 +216,21 @@ def compute_vec_tensor_eigen(fbr_vec):
     Parameters
     ----------
     fbr_vec: numpy.ndarray (shape=(N,3), dtype=float)
-        fiber orientation vectors
-        (reshaped super-voxel of shape=(Nz,Ny,Nx), i.e. N=Nz*Ny*Nx)
+        non-zero fiber orientation vectors
+        (reshaped super-voxel of shape=(Nz,Ny,Nx), i.e. N<=Nz*Ny*Nx)
 
     Returns
     -------
     vec_tensor_eigen: numpy.ndarray (shape=(3,), dtype=float32)
         orientation tensor eigenvalues in ascending order
     """
-    fbr_vec = np.delete(fbr_vec, np.all(fbr_vec == 0, axis=-1), axis=0)
-    fbr_vec.shape = (-1, 3)
     t = np.zeros((3, 3))
-    for v in fbr_vec:
-        t += np.outer(v, v)
+    for v in range(fbr_vec.shape[0]):
+        for i in range(3):
+            for j in range(3):
+                t[i, j] += fbr_vec[v, i] * fbr_vec[v, j]
 
-    vec_tensor_eigen = sp.linalg.eigh(t, eigvals_only=True).astype(np.float32)
+    vec_tensor_eigen = np.linalg.eigvalsh(t).astype(np.float32)
 
     return vec_tensor_eigen
 
@@ -207,7 +264,8 @@ def generate_odf_background(bg_mrtrix, fbr_vec, scale, iso_fbr=None):
         min_glob = np.min(bg_img)
         max_glob = np.max(bg_img)
 
-    # loop over z-slices, rescale and resize them
+    # loop over the central z-slices of the super-voxels, rescale them
+    # and average their super-voxel blocks
     for z in range(scale // 2, bg_img.shape[0], scale):
         if bg_img.ndim == 3:
             tmp_slice = normalize_image(bg_img[z], min_val=min_glob, max_val=max_glob)
@@ -215,9 +273,8 @@ def generate_odf_background(bg_mrtrix, fbr_vec, scale, iso_fbr=None):
             tmp_slice = 255.0 * np.sum(np.abs(bg_img[z, ...]), axis=-1)
             tmp_slice = np.where(tmp_slice <= 255.0, tmp_slice, 255.0)
 
-        tmp_slice = transform_axes(tmp_slice, swapped=(0, 1), flipped=(0, 1))
-        bg_mrtrix[..., z // scale] = \
-            resize(tmp_slice, output_shape=bg_mrtrix.shape[:-1], anti_aliasing=True, preserve_range=True)
+        tmp_slice = transform_axes(compute_block_mean(tmp_slice, scale), swapped=(0, 1), flipped=(0, 1))
+        bg_mrtrix[..., z // scale] = tmp_slice
 
 
 def init_odf_arrays(vec_img_shp, tmp_dir, scale, deg=6, exp_all=False):
@@ -1,15 +1,24 @@
+import atexit
+import json
 import psutil
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from os import makedirs, mkdir, path
+from math import prod
+from os import makedirs, path, scandir
+from shutil import disk_usage, rmtree
 
-import nibabel as nib
 import numpy as np
-from tifffile import TiffWriter
 
 from foa3d.printing import print_flsh
-from foa3d.utils import get_item_size
+
+# ratio between the space taken by the temporary arrays and the decoded input image size,
+# per byte of 8-bit grayscale input (worst case, all arrays exported):
+# image copy (1) + orientation vectors (3 x float32 = 12) + RGB orientation colormap (3)
+# + isotropic fiber image (1) + Frangi filter response (1) + fiber mask (1)
+# + fractional anisotropy (float32 = 4) + soma mask (1) = 24
+SHM_RATIO = 24
 
 
 def create_save_dirs(cli_args, in_img):
@@ -64,39 +73,159 @@ def create_save_dirs(cli_args, in_img):
             odf: ODF analysis
 
             tmp: temporary data
+
+            tmp_rsv: RAM reserved by the temporary data
+                     on the shared memory file system [B]
     """
     # get output path
     out_path = cli_args.out
     if out_path is None:
         out_path = path.dirname(in_img['path'])
 
-    # create saving directory
+    # create saving directory tree
+    # (Frangi filter and optional ODF analysis output subdirectories)
     time_stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
     base_out_dir = path.join(out_path, f"Foa3D_{time_stamp}_{in_img['name']}")
-    if not path.isdir(base_out_dir):
-        makedirs(base_out_dir)
-
-    # create Frangi filter output subdirectory
-    save_dirs = {}
-    frangi_dir = path.join(base_out_dir, 'frangi')
-    mkdir(frangi_dir)
-    save_dirs['frangi'] = frangi_dir
-
-    # create ODF analysis output subdirectory
-    if cli_args.odf_res is not None:
-        odf_dir = path.join(base_out_dir, 'odf')
-        mkdir(odf_dir)
-        save_dirs['odf'] = odf_dir
-    else:
-        save_dirs['odf'] = None
+    save_dirs = {'frangi': path.join(base_out_dir, 'frangi'),
+                 'odf': path.join(base_out_dir, 'odf') if cli_args.odf_res is not None else None}
+    for out_dir in save_dirs.values():
+        if out_dir is not None:
+            makedirs(out_dir, exist_ok=True)
+
+    # save the full pipeline configuration (identified by the output filename label)
+    with open(path.join(base_out_dir, 'config.json'), 'w') as cfg_file:
+        json.dump(vars(cli_args), cfg_file, indent=4, sort_keys=True)
 
     # create temporary directory
-    save_dirs['tmp'] = tempfile.mkdtemp(dir=base_out_dir)
+    # (removed at interpreter exit, also when the pipeline fails)
+    tmp_root, save_dirs['tmp_rsv'] = get_tmp_root(cli_args, in_img, base_out_dir)
+    save_dirs['tmp'] = tempfile.mkdtemp(dir=tmp_root)
+    atexit.register(rmtree, save_dirs['tmp'], ignore_errors=True)
 
     return save_dirs
 
 
-def save_array(fname, save_dir, nd_array, px_sz=None, fmt='tiff', ram=None):
+def get_decoded_size(in_img):
+    """
+    Get the in-memory size of the input image
+    from the headers of its NumPy or TIFF file(s).
+
+    Parameters
+    ----------
+    in_img: dict
+        input image dictionary
+
+            path: str
+                path to the 3D microscopy image
+
+            fmt: str
+                format of the 3D microscopy image
+
+    Returns
+    -------
+    dec_sz: int
+        decoded image size [B]
+    """
+    img_path = in_img['path']
+    if in_img['fmt'] == 'npy':
+        dec_sz = np.load(img_path, mmap_mode='r').nbytes
+
+    else:
+        import tifffile as tiff
+
+        if path.isdir(img_path):
+            pln_paths = [f.path for f in scandir(img_path)
+                         if f.is_file() and f.name.lower().endswith(('.tif', '.tiff'))]
+        else:
+            pln_paths = [img_path]
+
+        dec_sz = 0
+        if len(pln_paths) > 0:
+            with tiff.TiffFile(pln_paths[0]) as tif:
+                dec_sz = len(pln_paths) * tif.series[0].nbytes
+
+    return dec_sz
+
+
+def get_tmp_root(cli_args, in_img, base_out_dir, shm_dir='/dev/shm', shm_ratio=SHM_RATIO):
+    """
+    Select the parent folder of the temporary directory:
+    the RAM-backed shared memory file system is preferred
+    when no output directory is specified by the user
+    and enough space is available for the memory-mapped arrays.
+
+    Parameters
+    ----------
+    cli_args: see ArgumentParser.parse_args
+        updated namespace of command line arguments
+
+    in_img: dict
+        input image dictionary
+
+    base_out_dir: str
+        base output directory
+
+    shm_dir: str
+        shared memory file system mount point
+
+    shm_ratio: int
+        ratio between the space required by the temporary arrays
+        and the decoded input image size (conservative estimate)
+
+    Returns
+    -------
+    tmp_root: str
+        parent folder of the temporary directory
+
+    tmp_rsv: int
+        RAM reserved by the temporary data
+        on the shared memory file system [B]
+    """
+    tmp_root, tmp_rsv = base_out_dir, 0
+    if cli_args.out is None and not in_img['is_tiled'] and path.isdir(shm_dir):
+
+        # fall back to the output directory if the image size cannot be estimated
+        try:
+            shm_rsv = shm_ratio * get_decoded_size(in_img)
+        except Exception:
+            return tmp_root, tmp_rsv
+
+        # leave at least as much RAM for processing
+        if min(disk_usage(shm_dir).free, psutil.virtual_memory()[1] // 2) >= shm_rsv:
+            tmp_root, tmp_rsv = shm_dir, shm_rsv
+
+    return tmp_root, tmp_rsv
+
+
+def iter_z_planes(nd_array, dz):
+    """
+    Iterate over the z-planes of an array,
+    copying the next z-chunk into memory while the current one is consumed
+    (page faults on memory-mapped arrays occur in the prefetching thread).
+
+    Parameters
+    ----------
+    nd_array: NumPy memory-map object
+        data
+
+    dz: int
+        z-chunk size [px]
+
+    Yields
+    ------
+    pln: numpy.ndarray
+        in-memory z-plane
+    """
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        nxt_chk = prefetch.submit(np.array, nd_array[:dz, ...], copy=True)
+        for z in range(0, nd_array.shape[0], dz):
+            chk = nxt_chk.result()
+            if z + dz < nd_array.shape[0]:
+                nxt_chk = prefetch.submit(np.array, nd_array[z + dz:z + 2 * dz, ...], copy=True)
+            yield from chk
+
+
+def save_array(fname, save_dir, nd_array, px_sz=None, fmt='tiff', ram=None, cmp='none'):
     """
     Save array to file.
 
@@ -120,23 +249,28 @@ def save_array(fname, save_dir, nd_array, px_sz=None, fmt='tiff', ram=None):
     ram: float
         maximum RAM available
 
+    cmp: str
+        TIFF compression ('none', 'zlib' or 'zstd')
+
     Returns
     -------
     None
     """
     # get maximum RAM and initialized array memory size
+    # (two z-chunks are held in memory at once)
     if ram is None:
         ram = psutil.virtual_memory()[1]
-    itm_sz = get_item_size(nd_array.dtype)
-    dz = np.floor(ram / (itm_sz * np.prod(nd_array.shape[1:]))).astype(int)
-    nz = np.ceil(nd_array.shape[0] / dz).astype(int)
+    pln_sz = nd_array.dtype.itemsize * prod(nd_array.shape[1:])
+    dz = max(1, int(ram // (2 * pln_sz)))
 
     # check output format
     fmt = fmt.lower()
     if fmt in ('tif', 'tiff'):
+        from tifffile import TiffWriter
 
         # retrieve image pixel size
-        px_sz_z, px_sz_y, px_sz_x = px_sz
+        # (as Python floats, serializable to the JSON image description)
+        px_sz_z, px_sz_y, px_sz_x = (float(p) for p in px_sz)
 
         # adjust axes (for correct visualization in Fiji)
         if nd_array.ndim == 3:
@@ -146,16 +280,24 @@ def save_array(fname, save_dir, nd_array, px_sz=None, fmt='tiff', ram=None):
         bigtiff = nd_array.itemsize * nd_array.size >= 4294967296
         metadata = {'axes': 'ZCYX', 'spacing': px_sz_z, 'unit': 'um'}
         out_name = f'{fname}.{fmt}'
+
+        # write a single TIFF series from the z-planes of prefetched z-chunks
+        # (compressed strips are encoded by parallel threads)
+        compression = None if cmp == 'none' else cmp
+        cmp_args = {'level': 3} if cmp == 'zstd' else None
         with TiffWriter(path.join(save_dir, out_name), bigtiff=bigtiff, append=True) as tif:
-            for z in range(nz):
-                zs = z * dz
-                tif.write(nd_array[zs:zs + dz, ...],
-                          contiguous=True,
-                          resolution=(1 / px_sz_x, 1 / px_sz_y),
-                          metadata=metadata)
+            tif.write(iter_z_planes(nd_array, dz),
+                      shape=nd_array.shape,
+                      dtype=nd_array.dtype,
+                      compression=compression,
+                      compressionargs=cmp_args,
+                      resolution=(1 / px_sz_x, 1 / px_sz_y),
+                      metadata=metadata)
 
     # save array to NIfTI file
     elif fmt == 'nii':
+        import nibabel as nib
+
         nd_array = nib.Nifti1Image(nd_array, np.eye(4))
         nd_array.to_filename(path.join(save_dir, fname + '.nii'))
 
@@ -164,7 +306,7 @@ def save_array(fname, save_dir, nd_array, px_sz=None, fmt='tiff', ram=None):
         raise ValueError("Unsupported data format!!!")
 
 
-def save_frangi_arrays(save_dir, img_name, out_img, ram=None):
+def save_frangi_arrays(save_dir, img_name, out_img, ram=None, cmp='none'):
     """
     Save the output arrays of the Frangi filter stage to TIF files.
 
@@ -204,19 +346,27 @@ def save_frangi_arrays(save_dir, img_name, out_img, ram=None):
     ram: float
         maximum RAM available
 
+    cmp: str
+        TIFF compression ('none', 'zlib' or 'zstd')
+
     Returns
     -------
     None
     """
+    # query the available RAM once for all the saved arrays
+    if ram is None:
+        ram = psutil.virtual_memory()[1]
+
     # loop over output image dictionary fields and save to TIFF files
     for img_key in out_img.keys():
         if isinstance(out_img[img_key], np.ndarray) and img_key not in (None, 'iso'):
-            save_array(f'{img_key}_{img_name}', save_dir, out_img[img_key], out_img['px_sz'], ram=ram)
+            save_array(f'{img_key}_{img_name}', save_dir, out_img[img_key], out_img['px_sz'], ram=ram, cmp=cmp)
 
     print_flsh(f"\nFrangi filter arrays saved to: {save_dir}\n")
 
 
-def save_odf_arrays(save_dir, img_name, odf_scale_um, px_sz, odf, bg, fbr_dnst, odi_pri, odi_sec, odi_tot, odi_anis):
+def save_odf_arrays(save_dir, img_name, odf_scale_um, px_sz, odf, bg, fbr_dnst, odi_pri, odi_sec, odi_tot, odi_anis,
+                    ram=None, cmp='none'):
     """
     Save the output arrays of the ODF analysis stage to TIF and Nifti files.
     Arrays tagged with 'mrtrixview' are preliminarily transformed
@@ -258,10 +408,20 @@ def save_odf_arrays(save_dir, img_name, odf_scale_um, px_sz, odf, bg, fbr_dnst,
     odi_anis: NumPy memory-map object (axis order=(Z,Y,X), dtype=float32)
         orientation dispersion anisotropy parameter
 
+    ram: float
+        maximum RAM available
+
+    cmp: str
+        TIFF compression ('none', 'zlib' or 'zstd')
+
     Returns
     -------
     None
     """
+    # query the available RAM once for all the saved arrays
+    if ram is None:
+        ram = psutil.virtual_memory()[1]
+
     # save ODF image with background to NIfTI files (adjusted view for MRtrix3)
     sbfx = f'{odf_scale_um}_{img_name}'
     save_array(f'bg_mrtrixview_sv{sbfx}', save_dir, bg, fmt='nii')
@@ -270,24 +430,24 @@ def save_odf_arrays(save_dir, img_name, odf_scale_um, px_sz, odf, bg, fbr_dnst,
     del odf
 
     # save fiber density
-    save_array(f'fbr_dnst_sv{sbfx}', save_dir, fbr_dnst, px_sz)
+    save_array(f'fbr_dnst_sv{sbfx}', save_dir, fbr_dnst, px_sz, ram=ram, cmp=cmp)
     del fbr_dnst
 
     # save total orientation dispersion
-    save_array(f'odi_tot_sv{sbfx}', save_dir, odi_tot, px_sz)
+    save_array(f'odi_tot_sv{sbfx}', save_dir, odi_tot, px_sz, ram=ram, cmp=cmp)
     del odi_tot
 
     # save primary orientation dispersion
     if odi_pri is not None:
-        save_array(f'odi_pri_sv{sbfx}', save_dir, odi_pri, px_sz)
+        save_array(f'odi_pri_sv{sbfx}', save_dir, odi_pri, px_sz, ram=ram, cmp=cmp)
         del odi_pri
 
     # save secondary orientation dispersion
     if odi_sec is not None:
-        save_array(f'odi_sec_sv{sbfx}', save_dir, odi_sec, px_sz)
+        save_array(f'odi_sec_sv{sbfx}', save_dir, odi_sec, px_sz, ram=ram, cmp=cmp)
         del odi_sec
 
     # save orientation dispersion anisotropy
     if odi_anis is not None:
-        save_array(f'odi_anis_sv{sbfx}', save_dir, odi_anis, px_sz)
+        save_array(f'odi_anis_sv{sbfx}', save_dir, odi_anis, px_sz, ram=ram, cmp=cmp)
         del odi_anis
@@ -4,7 +4,7 @@ from joblib import Parallel, delayed
 
 from foa3d.frangi import (frangi_filter, init_frangi_arrays, mask_background,
                           write_frangi_arrays)
-from foa3d.input import get_frangi_config, get_resource_config
+from foa3d.input import get_frangi_config, get_resolution, get_resource_config
 from foa3d.odf import (compute_odf_map, generate_odf_background,
                        init_odf_arrays)
 from foa3d.output import save_frangi_arrays, save_odf_arrays
@@ -14,11 +14,9 @@ from foa3d.printing import (print_flsh, print_frangi_config,
 from foa3d.slicing import (check_background, get_slicing_config,
                            generate_slice_ranges, crop,
                            crop_img_dict, slice_image)
-from foa3d.spharm import get_sph_harm_norm_factors
-from foa3d.utils import get_available_cores
 
 
-def parallel_frangi_over_slices(cli_args, save_dirs, in_img):
+def parallel_frangi_over_slices(cli_args, save_dirs, in_img, sv_pool=None, sv_ram=None):
     """
     Apply 3D Frangi filtering to basic TPFM image slices using parallel threads.
 
@@ -36,6 +34,9 @@ def parallel_frangi_over_slices(cli_args, save_dirs, in_img):
 
             tmp: temporary data
 
+            tmp_rsv: RAM reserved by the temporary data
+                     on the shared memory file system [B]
+
     in_img: dict
         input image dictionary
 
@@ -88,6 +89,14 @@ def parallel_frangi_over_slices(cli_args, save_dirs, in_img):
             item_sz: int
                 image item size [B]
 
+    sv_pool: concurrent.futures.ThreadPoolExecutor
+        optional executor saving the output arrays in the background
+        (the arrays are saved before returning if None)
+
+    sv_ram: float
+        maximum RAM available to the background saving of the output arrays [B]
+        (share of the overall budget not used by the concurrent ODF stage)
+
     Returns
     -------
     out_img: dict
@@ -116,8 +125,14 @@ def parallel_frangi_over_slices(cli_args, save_dirs, in_img):
 
             px_sz: numpy.ndarray (shape=(3,), dtype=float)
                 output pixel size [μm]
+
+    sv_job: concurrent.futures.Future
+        pending background saving of the output arrays
+        (None if no background executor is provided
+        or the Frangi filter stage is skipped)
     """
     # skip the Frangi filter stage if an orientation vector field was provided as input
+    sv_job = None
     if in_img['is_vec']:
         out_img = {'vec': in_img['data'], 'iso': None, 'px_sz': None}
 
@@ -127,7 +142,7 @@ def parallel_frangi_over_slices(cli_args, save_dirs, in_img):
         out_img = init_frangi_arrays(in_img, frangi_cfg, save_dirs['tmp'])
 
         # get parallel processing configuration
-        get_resource_config(cli_args, frangi_cfg)
+        get_resource_config(cli_args, frangi_cfg, rsv=save_dirs['tmp_rsv'])
         get_slicing_config(in_img, frangi_cfg)
 
         # conduct a Frangi-filter-based analysis of fiber orientations using concurrent workers
@@ -138,10 +153,17 @@ def parallel_frangi_over_slices(cli_args, save_dirs, in_img):
         with Parallel(n_jobs=frangi_cfg['batch'], prefer='threads') as parallel:
             parallel(delayed(frangi_analysis)(s, in_img, out_img, frangi_cfg, t_start, _fa=_fa) for s in slc_rng)
 
-        # save output arrays to file
-        save_frangi_arrays(save_dirs['frangi'], in_img['name'], out_img, ram=frangi_cfg['ram'])
+        # save output arrays to file (optionally overlapping the following ODF stage)
+        sv_args = (save_dirs['frangi'], in_img['name'], out_img)
+        sv_kwargs = {'ram': frangi_cfg['ram'], 'cmp': cli_args.tiff_cmp}
+        if sv_pool is None:
+            save_frangi_arrays(*sv_args, **sv_kwargs)
+        else:
+            if sv_ram is not None:
+                sv_kwargs['ram'] = sv_ram
+            sv_job = sv_pool.submit(save_frangi_arrays, *sv_args, **sv_kwargs)
 
-    return out_img
+    return out_img, sv_job
 
 
 def frangi_analysis(rng, in_img, out_img, cfg, t_start, _fa=False):
@@ -557,10 +579,10 @@ def reject_brain_cells(bc_slc, out_slc, rsz_ratio, out_rng, bc_thr='yen'):
     return out_slc
 
 
-def parallel_odf_over_scales(cli_args, save_dirs, out_img, img_name):
+def parallel_odf_over_scales(cli_args, save_dirs, out_img, img_name, ram=None):
     """
     Iterate over the required spatial scales and apply the parallel ODF analysis
-    implemented in parallel_odf_on_slices().
+    implemented in odf_analysis().
 
     Parameters
     ----------
@@ -606,6 +628,9 @@ def parallel_odf_over_scales(cli_args, save_dirs, out_img, img_name):
     img_name: str
         name of the input volume image
 
+    ram: float
+        maximum RAM available to the saving of the ODF stage arrays [B]: use all if None
+
     Returns
     -------
     None
@@ -617,20 +642,20 @@ def parallel_odf_over_scales(cli_args, save_dirs, out_img, img_name):
         # if a vector field was directly provided to Foa3D
         px_sz = out_img['px_sz']
         if px_sz is None:
-            px_sz = (cli_args.px_size_z, cli_args.px_size_xy, cli_args.px_size_xy)
+            px_sz, _ = get_resolution(cli_args)
 
-        # parallel ODF analysis of fiber orientation vectors over the spatial scales of interest
-        batch_sz = min(len(cli_args.odf_res), get_available_cores())
-        odf_norm = get_sph_harm_norm_factors(cli_args.odf_deg)
-        with Parallel(n_jobs=batch_sz, verbose=10, prefer='threads') as parallel:
-            parallel(delayed(odf_analysis)(out_img['vec'], out_img['iso'], px_sz, save_dirs, img_name,
-                                           odf_norm=odf_norm, odf_deg=cli_args.odf_deg, odf_scale_um=s,
-                                           exp_all=cli_args.exp_all) for s in cli_args.odf_res)
+        # ODF analysis of fiber orientation vectors over the spatial scales of interest
+        # (super-voxels are processed in parallel at each scale)
+        for s in cli_args.odf_res:
+            odf_analysis(out_img['vec'], out_img['iso'], px_sz, save_dirs, img_name,
+                         odf_deg=cli_args.odf_deg, odf_scale_um=s, exp_all=cli_args.exp_all,
+                         tiff_cmp=cli_args.tiff_cmp, ram=ram)
 
         print_flsh(f"\nODF and dispersion maps saved to: {save_dirs['odf']}\n")
 
 
-def odf_analysis(fbr_vec, iso_fbr, px_sz, save_dirs, img_name, odf_scale_um, odf_norm, odf_deg=6, exp_all=False):
+def odf_analysis(fbr_vec, iso_fbr, px_sz, save_dirs, img_name, odf_scale_um, odf_deg=6, exp_all=False,
+                 tiff_cmp='none', ram=None):
     """
     Estimate 3D fiber ODFs from basic orientation data chunks using parallel threads.
 
@@ -655,15 +680,18 @@ def odf_analysis(fbr_vec, iso_fbr, px_sz, save_dirs, img_name, odf_scale_um, odf
     odf_scale_um: float
         fiber ODF resolution (super-voxel side [μm])
 
-    odf_norm: numpy.ndarray (dtype: float)
-        2D array of spherical harmonic normalization factors
-
     odf_deg: int
         degrees of the spherical harmonic series expansion
 
     exp_all: bool
         export all images
 
+    tiff_cmp: str
+        TIFF compression ('none', 'zlib' or 'zstd')
+
+    ram: float
+        maximum RAM available to the saving of the output arrays [B]: use all if None
+
     Returns
     -------
     None
@@ -675,7 +703,8 @@ def odf_analysis(fbr_vec, iso_fbr, px_sz, save_dirs, img_name, odf_scale_um, odf
 
     # generate ODF coefficients and down-sampled background for visualization in MRtrix3
     generate_odf_background(bg_mrtrix, fbr_vec, scale=odf_scale, iso_fbr=iso_fbr)
-    odf, dnst = compute_odf_map(fbr_vec, px_sz, odf, odi, dnst, vec_tensor_eigen, odf_scale, odf_norm, deg=odf_deg)
+    odf, dnst = compute_odf_map(fbr_vec, px_sz, odf, odi, dnst, vec_tensor_eigen, odf_scale, deg=odf_deg)
 
     # save output arrays to TIFF or NIfTI files
-    save_odf_arrays(save_dirs['odf'], img_name, odf_scale_um, px_sz, odf, bg_mrtrix, dnst, **odi)
+    save_odf_arrays(save_dirs['odf'], img_name, odf_scale_um, px_sz, odf, bg_mrtrix, dnst, **odi,
+                    ram=ram, cmp=tiff_cmp)
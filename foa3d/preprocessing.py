@@ -1,6 +1,4 @@
 import numpy as np
-from scipy.ndimage import gaussian_filter
-from skimage.transform import resize
 
 from foa3d.printing import print_blur, print_flsh, print_prepro_heading
 from foa3d.utils import fwhm_to_sigma
@@ -34,7 +32,7 @@ def config_anisotropy_correction(px_sz, psf_fwhm):
         new isotropic pixel size [μm]
     """
     # set the isotropic pixel size to the maximum size along each axis
-    px_sz_iso = tuple(np.max(px_sz) * np.ones(shape=(3,)))
+    px_sz_iso = tuple(np.full(3, np.max(px_sz), dtype=np.float32))
 
     # detect preprocessing requirements
     crt_1 = not np.all(psf_fwhm == psf_fwhm[0])
@@ -50,7 +48,7 @@ def config_anisotropy_correction(px_sz, psf_fwhm):
             # and tailor the standard deviation of the smoothing Gaussian kernel [px]
             psf_var = np.square(fwhm_to_sigma(psf_fwhm))
             smooth_sigma_um = np.sqrt(np.max(psf_var) - psf_var)
-            smooth_sigma = np.divide(smooth_sigma_um, px_sz)
+            smooth_sigma = np.divide(smooth_sigma_um, px_sz, dtype=np.float32)
 
             print_blur(smooth_sigma_um, psf_fwhm)
 
@@ -112,6 +110,9 @@ def correct_anisotropy(img, rsz, sigma=None, pad=None, ts_msk=None):
 
     # adaptive image blurring
     else:
+        from scipy.ndimage import gaussian_filter
+        from skimage.transform import resize
+
         if sigma is not None:
             img = gaussian_filter(img, sigma=sigma, mode='reflect', output=np.float32)
 
@@ -125,6 +125,9 @@ def print_frangi_config(in_img, cfg):
             item_sz: int
                 image item size [B]
 
+            nbytes: int
+                total image size [B]
+
     cfg: dict
         Frangi filter configuration
 
@@ -211,7 +214,8 @@ def print_frangi_config(in_img, cfg):
     # print parallel processing information
     batch_sz = cfg['batch']
     slc_shp_um = np.multiply(cfg['px_sz'], cfg['slc_shp'])
-    print_slicing_info(in_img['shape_um'], slc_shp_um, in_img['px_sz'], in_img['item_sz'], in_img['msk_bc'])
+    print_slicing_info(in_img['shape_um'], in_img['nbytes'], slc_shp_um, in_img['px_sz'], in_img['item_sz'],
+                       in_img['msk_bc'])
     print_flsh(f"[Parallel(n_jobs={batch_sz})]: Using backend ThreadingBackend with {batch_sz} concurrent workers.")
 
 
@@ -340,7 +344,7 @@ def print_prepro_heading():
                "\n                              Z      Y      X")
 
 
-def print_slicing_info(img_shp_um, slc_shp_um, px_sz, item_sz, msk_bc):
+def print_slicing_info(img_shp_um, img_sz, slc_shp_um, px_sz, item_sz, msk_bc):
     """
     Print information on the slicing of the basic image sub-volumes processed by the Foa3D tool.
 
@@ -349,6 +353,9 @@ def print_slicing_info(img_shp_um, slc_shp_um, px_sz, item_sz, msk_bc):
     img_shp_um: numpy.ndarray (shape=(3,), dtype=float)
         3D microscopy image [μm]
 
+    img_sz: int
+        3D microscopy image size (in bytes)
+
     slc_shp_um: numpy.ndarray (shape=(3,), dtype=float)
         shape of the analyzed image slices [μm]
 
@@ -370,17 +377,13 @@ def print_slicing_info(img_shp_um, slc_shp_um, px_sz, item_sz, msk_bc):
     if np.any(img_shp_um < slc_shp_um):
         slc_shp_um = img_shp_um
 
-    # get memory sizes
-    img_sz = item_sz * np.prod(np.divide(img_shp_um, px_sz))
+    # get memory size of the basic image slices
     max_slc_sz = item_sz * np.prod(np.divide(slc_shp_um, px_sz))
 
-    # print total image and basic slices information
-    print_flsh("\n                              Z      Y      X")
-    print_flsh(f"Total image shape    [μm]: ({img_shp_um[0]:.1f}, {img_shp_um[1]:.1f}, {img_shp_um[2]:.1f})\n" +
+    # print total image and basic slices information (single flushed write)
+    print_flsh("\n                              Z      Y      X\n" +
+               f"Total image shape    [μm]: ({img_shp_um[0]:.1f}, {img_shp_um[1]:.1f}, {img_shp_um[2]:.1f})\n" +
                f"Total image size     [MB]: {np.ceil(img_sz / 1024**2).astype(int)}\n\n" +
                f"Image slice shape    [μm]: ({slc_shp_um[0]:.1f}, {slc_shp_um[1]:.1f}, {slc_shp_um[2]:.1f})\n" +
-               f"Image slice size     [MB]: {np.ceil(max_slc_sz / 1024**2).astype(int)}\n")
-    if msk_bc:
-        print_flsh('Soma mask: active\n')
-    else:
-        print_flsh('Soma mask: not active\n')
+               f"Image slice size     [MB]: {np.ceil(max_slc_sz / 1024**2).astype(int)}\n\n" +
+               f"Soma mask: {'active' if msk_bc else 'not active'}\n")
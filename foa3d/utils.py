@@ -1,18 +1,16 @@
-import gc
+import json
+import psutil
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
 from multiprocessing import cpu_count
 from os import environ, path, unlink
 from shutil import rmtree
 from time import perf_counter
 
 import numpy as np
-from astropy.visualization import make_lupton_rgb
-from joblib import dump, load
-from matplotlib.colors import hsv_to_rgb
-from skimage.filters import (threshold_li, threshold_niblack,
-                             threshold_sauvola, threshold_triangle,
-                             threshold_yen)
+from numba import njit, prange
 
 
 def ceil_to_multiple(number, multiple):
@@ -38,6 +36,88 @@ def ceil_to_multiple(number, multiple):
     return rounded
 
 
+def compute_block_mean(img, side):
+    """
+    Down-sample an image by averaging its non-overlapping blocks
+    (partial blocks at the image boundary are averaged over their actual size).
+
+    Parameters
+    ----------
+    img: numpy.ndarray
+        input image
+
+    side: int
+        block side [px]
+
+    Returns
+    -------
+    blk_mean: numpy.ndarray (dtype=float)
+        down-sampled image
+    """
+    blk_mean = img
+    for ax in range(img.ndim):
+        blk_idx = np.arange(0, img.shape[ax], side)
+        blk_sz = np.diff(np.append(blk_idx, img.shape[ax]))
+        blk_mean = np.add.reduceat(blk_mean, blk_idx, axis=ax, dtype=np.float64)
+        blk_mean /= np.expand_dims(blk_sz, axis=tuple(range(1, img.ndim - ax)))
+
+    return blk_mean
+
+
+def compute_tissue_mip(img, ch_ax=None, ch=None, dz=None, chk_sz=2**26):
+    """
+    Compute the maximum intensity projection (MIP) of the input fiber channel
+    along the z-axis, reducing z-chunks of bounded memory size in place
+    (the channel is selected within each z-chunk read window).
+
+    Parameters
+    ----------
+    img: numpy.ndarray, NumPy memory-map object or ZetaStitcher VirtualFusedVolume
+        3D microscopy image (axis order=(Z,Y,X) or (Z,Y,X,C) or (Z,C,Y,X))
+
+    ch_ax: int
+        RGB image channel axis (either 1, 3, or None for grayscale images)
+
+    ch: int
+        neuronal fibers channel
+
+    dz: int
+        z-chunk size [px] (if None, bounded by chk_sz)
+
+    chk_sz: int
+        maximum z-chunk memory size [B]
+
+    Returns
+    -------
+    ts_mip: numpy.ndarray (axis order=(Y,X))
+        maximum intensity projection
+    """
+    if ch_ax is None:
+        ch_idx = ()
+        mip_shp = img.shape[1:]
+    elif ch_ax == 1:
+        ch_idx = (ch,)
+        mip_shp = img.shape[2:]
+    else:
+        ch_idx = (Ellipsis, ch)
+        mip_shp = img.shape[1:3]
+
+    ts_mip = np.zeros(mip_shp, dtype=np.dtype(img.dtype).newbyteorder('='))
+    if dz is None:
+        dz = max(1, chk_sz // ts_mip.nbytes)
+
+    # prefetch the next z-chunk while reducing the current one
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        nxt_chk = prefetch.submit(read_z_chunk, img, 0, dz, ch_idx, ts_mip.dtype)
+        for z in range(0, img.shape[0], dz):
+            img_chk = nxt_chk.result()
+            if z + dz < img.shape[0]:
+                nxt_chk = prefetch.submit(read_z_chunk, img, z + dz, dz, ch_idx, ts_mip.dtype)
+            update_mip(img_chk.reshape((-1,) + mip_shp), ts_mip)
+
+    return ts_mip
+
+
 def create_background_mask(img, method='yen', black_bg=False):
     """
     Compute background mask.
@@ -58,6 +138,10 @@ def create_background_mask(img, method='yen', black_bg=False):
     bg_msk: numpy.ndarray (axis order=(Z,Y,X), dtype=bool)
         boolean background mask
     """
+    from skimage.filters import (threshold_li, threshold_niblack,
+                                 threshold_sauvola, threshold_triangle,
+                                 threshold_yen)
+
     # select thresholding method
     if method == 'li':
         thresh = threshold_li(img)
@@ -81,7 +165,7 @@ def create_background_mask(img, method='yen', black_bg=False):
     return bg_msk
 
 
-def create_memory_map(shape, dtype, name='tmp', tmp=None, arr=None, mmap_mode='w+'):
+def create_memory_map(shape, dtype, name='tmp', tmp=None, mmap_mode='w+'):
     """
     Create a memory-map to an array stored in a binary file on disk.
 
@@ -99,9 +183,6 @@ def create_memory_map(shape, dtype, name='tmp', tmp=None, arr=None, mmap_mode='w
     tmp: str
         temporary file directory
 
-    arr: numpy.ndarray
-        array to be mapped
-
     mmap_mode: str
         file opening mode
 
@@ -117,15 +198,7 @@ def create_memory_map(shape, dtype, name='tmp', tmp=None, arr=None, mmap_mode='w
     if path.exists(mmap_path):
         unlink(mmap_path)
 
-    if arr is None:
-        _ = open(mmap_path, mode='w+')
-        mmap = np.memmap(mmap_path, dtype=dtype, mode=mmap_mode, shape=shape)
-        mmap[:] = 0
-    else:
-        _ = dump(arr, mmap_path)
-        mmap = load(mmap_path, mmap_mode=mmap_mode)
-        del arr
-        _ = gc.collect()
+    mmap = np.memmap(mmap_path, dtype=dtype, mode=mmap_mode, shape=shape)
 
     return mmap
 
@@ -281,81 +354,80 @@ def get_available_cores():
     return num_cpu
 
 
-def get_config_label(cli_args):
+def get_available_ram(ram=None, rsv=0):
     """
-    Generate the output filename prefix including
-    pipeline configuration information.
+    Return the RAM budget of the pipeline.
 
     Parameters
     ----------
-    cli_args: see ArgumentParser.parse_args
-        updated namespace of command line arguments
+    ram: float
+        maximum RAM available [B] (all if None)
+
+    rsv: int
+        RAM reserved by the temporary data
+        on the shared memory file system [B]
 
     Returns
     -------
-    cfg_lbl: str
-        Frangi filter configuration label
+    ram: float
+        RAM budget [B]
     """
-    cfg_lbl = f'a{cli_args.alpha}_b{cli_args.beta}_g{cli_args.gamma}_t{cli_args.fb_thr}'
-    for s in cli_args.scales:
-        cfg_lbl += f'_s{s}'
+    if ram is None:
+        ram = psutil.virtual_memory()[1] - rsv
+    elif rsv > 0:
+        ram = min(ram, psutil.virtual_memory()[1] - rsv)
 
-    return cfg_lbl
+    return ram
 
 
-def get_item_bytes(data):
+def get_config_label(cli_args, excl_keys=('image_path', 'out', 'jobs', 'ram', 'tiff_cmp', 'exp_all')):
     """
-    Retrieve data item size in bytes.
+    Generate a compact and stable output filename label
+    identifying the pipeline configuration
+    (hash of the canonicalized command line arguments).
 
     Parameters
     ----------
-    data: numpy.ndarray or HDF5 dataset
-        input data
+    cli_args: see ArgumentParser.parse_args
+        updated namespace of command line arguments
+
+    excl_keys: tuple
+        command line arguments not affecting the analysis results
+        (resources, output location and exported arrays)
 
     Returns
     -------
-    bts: int
-        item size in bytes
+    cfg_lbl: str
+        pipeline configuration label
     """
-    try:
-        bts = int(np.iinfo(data.dtype).bits / 8)
-    except ValueError:
-        bts = int(np.finfo(data.dtype).bits / 8)
+    cli_cfg = {k: v for k, v in vars(cli_args).items() if k not in excl_keys}
 
-    return bts
+    # hash the resolved spatial scales (unique, sorted and cast as in get_frangi_config)
+    for k in ('scales', 'odf_res'):
+        if cli_cfg.get(k) is not None:
+            cli_cfg[k] = np.unique(np.asarray(cli_cfg[k], dtype=np.float32)).tolist()
+    cfg_lbl = blake2b(json.dumps(cli_cfg, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+    return cfg_lbl
 
 
-def get_item_size(dtype):
+def get_item_bytes(data):
     """
-    Get the item size in bytes of a data type.
+    Retrieve data item size in bytes.
 
     Parameters
     ----------
-    dtype: str
-        data type identifier
+    data: numpy.ndarray or HDF5 dataset
+        input data
 
     Returns
     -------
-    item_sz: int
+    bts: int
         item size in bytes
     """
-    lst_1 = ['uint8', 'int8']
-    lst_2 = ['uint16', 'int16', 'float16', np.float16]
-    lst_3 = ['uint32', 'int32', 'float32', np.float32]
-    lst_4 = ['uint64', 'int64', 'float64', np.float64]
-
-    if dtype in lst_1:
-        item_sz = 1
-    elif dtype in lst_2:
-        item_sz = 2
-    elif dtype in lst_3:
-        item_sz = 4
-    elif dtype in lst_4:
-        item_sz = 8
-    else:
-        raise ValueError("Unsupported data type!")
+    bts = np.dtype(data.dtype).itemsize
 
-    return item_sz
+    return bts
 
 
 def hsv_orient_cmap(vec_img):
@@ -372,6 +444,8 @@ def hsv_orient_cmap(vec_img):
     rgb_map: numpy.ndarray (axis order=(Z,Y,X,C), dtype=uint8)
         orientation color map
     """
+    from matplotlib.colors import hsv_to_rgb
+
     # compute the in-plane versor length
     vy, vx = (vec_img[..., 1], vec_img[..., 2])
     vxy_abs = np.sqrt(np.square(vx) + np.square(vy))
@@ -483,6 +557,40 @@ def normalize_image(img, min_val=None, max_val=None, max_out_val=255.0, dtype=np
     return norm_img
 
 
+def read_z_chunk(img, z, dz, ch_idx, dtype):
+    """
+    Read a z-chunk of the input image into memory.
+    The chunk is always copied, also when the channel selection
+    would return a view of a memory-mapped array, so that the data
+    are actually read in the prefetching thread.
+
+    Parameters
+    ----------
+    img: numpy.ndarray, NumPy memory-map object or ZetaStitcher VirtualFusedVolume
+        3D microscopy image
+
+    z: int
+        first z-plane of the chunk
+
+    dz: int
+        z-chunk size [px]
+
+    ch_idx: tuple
+        channel index appended to the z-chunk slice
+
+    dtype:
+        output data type
+
+    Returns
+    -------
+    img_chk: numpy.ndarray
+        in-memory z-chunk
+    """
+    img_chk = np.array(img[(slice(z, z + dz),) + ch_idx], dtype=dtype)
+
+    return img_chk
+
+
 def rgb_orient_cmap(vec_img, minimum=0, stretch=1, q=8):
     """
     Compute RGB colormap of orientation vector components from 3D vector field.
@@ -506,6 +614,8 @@ def rgb_orient_cmap(vec_img, minimum=0, stretch=1, q=8):
     rgb_map: numpy.ndarray (axis order=(Z,Y,X,C), dtype=uint8)
         orientation color map
     """
+    from astropy.visualization import make_lupton_rgb
+
     # initialize colormap
     vec_img = np.abs(vec_img)
     rgb_map = np.zeros(shape=vec_img.shape, dtype=np.uint8)
@@ -554,3 +664,28 @@ def transform_axes(nd_array, flipped=None, swapped=None, expand=None):
         nd_array = np.expand_dims(nd_array, axis=expand)
 
     return nd_array
+
+
+@njit(cache=True, nogil=True, parallel=True)
+def update_mip(img_chk, mip):
+    """
+    Update the maximum intensity projection in place
+    with the maxima of the input z-chunk (parallel over y-rows).
+
+    Parameters
+    ----------
+    img_chk: numpy.ndarray (axis order=(Z,Y,X))
+        z-chunk of the fiber channel
+
+    mip: numpy.ndarray (axis order=(Y,X))
+        maximum intensity projection
+
+    Returns
+    -------
+    None
+    """
+    for y in prange(mip.shape[0]):
+        for z in range(img_chk.shape[0]):
+            for x in range(mip.shape[1]):
+                if img_chk[z, y, x] > mip[y, x]:
+                    mip[y, x] = img_chk[z, y, x]